@@ -1,17 +1,25 @@
 # app.py
-import os, uuid, shutil, time, re, random
+import os, uuid, time, re, random, asyncio, hashlib, json, logging
 from io import BytesIO
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List, Tuple, Optional
 from pathlib import Path
+from dataclasses import dataclass, replace
+from functools import lru_cache
 
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, UploadFile, File, Form, Query
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from PIL import Image, ImageDraw
+from jinja2 import Environment, DictLoader
 
+import requests
 from dotenv import load_dotenv
 from google import genai
+from google.genai import types
 
 # ---------- .env 로드 ----------
 BASE_DIR = Path(__file__).resolve().parent
@@ -21,10 +29,34 @@ if not API_KEY:
     raise RuntimeError("환경변수 GOOGLE_API_KEY(.env) 가 필요합니다.")
 
 # ---------- FastAPI ----------
-app = FastAPI(title="BillGates + You in Korea (4 shots, multi-reference, fast-fail)")
+logger = logging.getLogger("uvicorn.error")  # uvicorn 로그 설정을 그대로 따름
+# JSON 응답(/metrics 등)은 orjson으로 직렬화, HTML 라우트는 HTMLResponse를 직접 반환
+app = FastAPI(title="BillGates + You in Korea (4 shots, multi-reference, fast-fail)",
+              default_response_class=ORJSONResponse)
 STATIC_DIR = str(BASE_DIR / "static")
 os.makedirs(STATIC_DIR, exist_ok=True)
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+class _ImmutableStaticFiles(StaticFiles):
+    """결과 이미지는 UUID 파일명으로 한 번 쓰이고 바뀌지 않으므로 브라우저가 재검증 없이 캐시하게 함."""
+
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+app.mount("/static", _ImmutableStaticFiles(directory=STATIC_DIR), name="static")
+
+class _GZipExceptStreaming(GZipMiddleware):
+    """HTML/JSON 응답만 gzip. 스트리밍 결과 페이지는 gzip 버퍼가 타일 전송을 붙잡고,
+    /static 이미지는 이미 압축된 포맷이라 제외."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(("/generate", "/static/")):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(_GZipExceptStreaming, minimum_size=1024)
 
 # ---------- 장면(2컷, 고퀄리티) ----------
 SCENES: List[Tuple[str, str]] = [
@@ -34,212 +66,817 @@ SCENES: List[Tuple[str, str]] = [
      "at N Seoul Tower observatory, sunset golden hour lighting with Seoul skyline in background, both looking relaxed and happy, cinematic composition with perfect depth of field"),
 ]
 
+# ---------- 함께 찍을 인물 설정 (새 인물은 여기에만 추가) ----------
+@dataclass(frozen=True, slots=True)
+class CharacterCfg:
+    scenes: Tuple[Tuple[str, str], ...]
+    exact_phrase: str                  # 실존 인물로 시도할 때 PERSON B 표현
+    lookalike_phrase: str              # look-alike 표현 (정책/콘텐츠 이슈 시 전환)
+    allow_lookalike_fallback: bool     # 실존 인물 실패 시 look-alike로 1회 재시도 여부
+
+CHARACTERS = {
+    "billgates": CharacterCfg(
+        scenes=tuple(SCENES),
+        exact_phrase="Bill Gates",
+        lookalike_phrase="a Bill Gates look-alike (middle-aged Caucasian male with glasses)",
+        allow_lookalike_fallback=True,
+    ),
+}
+DEFAULT_CHARACTER = "billgates"
+
 # ---------- 레이트리밋/재시도/데드라인 설정 (빠른 실패 지향) ----------
-MIN_INTERVAL_BETWEEN_CALLS_SEC = 5     # 컷 사이 최소 간격 (짧게)
+GEMINI_MODEL = "gemini-2.5-flash-image-preview"  # 최고 성능 모델 (결과 캐시 키에도 포함)
+MIN_INTERVAL_BETWEEN_CALLS_SEC = 5     # 평균 호출 간격 (짧게) — 백오프 기본값으로도 사용
+GEMINI_RPM = 60 // MIN_INTERVAL_BETWEEN_CALLS_SEC  # 슬라이딩 윈도우(60초)당 최대 호출 수
+GEMINI_RPM_PER_CLIENT = max(1, GEMINI_RPM // 2)    # 한 클라이언트(IP)가 전역 쿼터를 독차지하지 않도록
+MAX_TRACKED_CLIENTS = 1024                         # 클라이언트별 리미터를 유지할 최근 IP 수
 MAX_RETRIES_PER_SHOT = 1               # 재시도 1회로 제한
-PER_REQUEST_DEADLINE_SEC = 35          # HTTP 요청 전체 대기 상한 (초)
-_last_call_ts = 0.0                    # 마지막 호출 시각(전역)
+PER_REQUEST_DEADLINE_SEC = 35          # HTTP 요청 전체 대기 상한 (초) — 요청 내 모든 호출이 같은 마감 시각을 공유
+MIN_CALL_BUDGET_SEC = 5                # 마감까지 남은 시간이 이보다 짧으면 새 Gemini 호출을 시작하지 않음
+OUTPUT_WEBP_QUALITY = 85               # 결과 이미지 WebP 품질 (PNG 대비 전송량 절감)
+# 모든 컷을 한 번의 호출로 묶어 요청(참조 사진 업로드 1회). 모자란 컷은 컷별 호출로 보충
+BATCH_SCENES_IN_ONE_CALL = os.getenv("GEMINI_BATCH_SCENES", "0") == "1"
+# 참조 사진을 명시적 컨텍스트 캐시에 한 번 올리고 컷별 호출은 프롬프트만 전송 (1=사용).
+# 모델/최소 토큰 수 조건으로 캐시 생성이 실패하면 자동으로 인라인 전송
+USE_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL_SEC = 300            # 요청이 끝나면 바로 지우지만, 삭제 실패 시에도 이 시간 뒤 만료
+
+# ---------- Gemini 클라이언트 (프로세스당 1개, 연결 풀 재사용) ----------
+# SDK의 aio 호출은 내부 스레드에서 실행되어 wait_for 로 취소해도 HTTP 요청이 계속 살아 있으므로,
+# 전송 계층에도 같은 데드라인(ms)을 걸어 멈춘 연결/스레드를 제때 반환
+GENAI_CLIENT = genai.Client(api_key=API_KEY, http_options={"timeout": PER_REQUEST_DEADLINE_SEC * 1000})
+GENAI_ASYNC = GENAI_CLIENT.aio
+
+# ---------- 동시성 제어 (AIMD: 성공 시 가산 증가, 429/지연 시 곱셈 감소) ----------
+AIMD_MIN_CONCURRENCY = 1               # 동시 Gemini 호출 하한
+AIMD_MAX_CONCURRENCY = max(AIMD_MIN_CONCURRENCY, int(os.getenv("GEMINI_MAX_INFLIGHT", "2")))  # 동시 Gemini 호출 상한
+AIMD_INITIAL_CONCURRENCY = min(4, AIMD_MAX_CONCURRENCY)  # 시작 시 동시 호출 한도 (요청 간 공유, 상한을 넘지 않음)
+AIMD_ALPHA = 0.5                       # 성공 1회당 한도 증가폭
+AIMD_BETA = 0.5                        # 429/5xx/타임아웃 시 한도 감소 배율
+AIMD_LATENCY_TARGET_SEC = 20.0         # 최근 평균 지연이 이 값을 넘으면 한도 감소
+AIMD_LATENCY_WINDOW = 20               # 평균 지연 계산에 쓰는 최근 호출 수
+
+# ---------- 업로드 제한 (요청당 메모리 상한 ≈ MAX_REFS × MAX_UPLOAD_BYTES) ----------
+MAX_REFS = 6                           # 참조로 쓰는 셀피 최대 장수 (초과분은 무시)
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024    # 셀피 1장당 최대 크기 (초과 시 413)
+
+# ---------- 결과 캐시 (같은 셀피 재제출 시 API 호출 생략) ----------
+RESULT_CACHE_INDEX_PATH = str(BASE_DIR / "result_cache.json")  # /static 밖에 둠(공개 금지)
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024                     # 캐시된 결과 이미지 총 용량 상한
+RESULT_CACHE_TTL_SEC = 24 * 3600                               # 이 시간이 지난 결과는 재생성
+# 유사 중복(재압축/리사이즈된 같은 사진) 참조도 캐시 적중으로 처리 (1=사용). 다른 사람 사진과 오적중할 수 있어 기본 꺼 둠
+RESULT_CACHE_NEAR_DUP = os.getenv("RESULT_CACHE_NEAR_DUP", "0") == "1"
+RESULT_CACHE_NEAR_DUP_MAX_DISTANCE = 6                         # 참조 사진별 dHash(64비트) 해밍 거리 상한
 
 # ---------- 유틸 ----------
 def visible_watermark(img: Image.Image, tag="AI-Generated"):
-    draw = ImageDraw.Draw(img)
+    # "RGBA" 모드 Draw는 반투명 채우기를 원본에 바로 블렌딩 — 오버레이 이미지 할당/합성 없음
+    draw = ImageDraw.Draw(img, "RGBA")
     w, h = img.size
     pad = 12
     bar_h = 36
-    overlay = Image.new("RGBA", (w, bar_h), (0, 0, 0, 90))
-    img.paste(overlay, (0, h - bar_h), overlay)
+    draw.rectangle([(0, h - bar_h), (w, h)], fill=(0, 0, 0, 90))
     draw.text((pad, h - bar_h + 8), f"{tag} • {datetime.now():%Y-%m-%d}", fill=(255, 255, 255, 220))
     return img
 
-def save_image_bytes(image_bytes: bytes, suffix=".png") -> str:
-    """디스크에 저장하고, 브라우저가 접근할 URL 경로('/static/..')를 반환."""
+def _write_new_file(fs_path: str, data: bytes):
+    """버퍼드 writer 없이 os.write로 바로 기록 (fsync 없음 — 재생성 가능한 결과물)."""
+    fd = os.open(fs_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+async def save_image_bytes(image_bytes: bytes, suffix=".png") -> str:
+    """스레드풀에서 한 번에 저장하고, 브라우저가 접근할 URL 경로('/static/..')를 반환."""
     out_name = f"{uuid.uuid4().hex}{suffix}"
     fs_path = os.path.join(STATIC_DIR, out_name)
-    with open(fs_path, "wb") as f:
-        f.write(image_bytes)
+    await asyncio.to_thread(_write_new_file, fs_path, image_bytes)
     return f"/static/{out_name}"
 
+# APIError 문자열은 응답 JSON(dict repr, 작은따옴표)을 포함하므로 따옴표 종류를 가리지 않음
+_RETRY_DELAY_RE = re.compile(r"""["']retryDelay["']\s*:\s*["'](\d+)s["']""")
+# "rate" 단독은 generate/moderate 등에도 걸리므로 rate limit 표현과 단어 경계의 429만 인정
+_QUOTA_RE = re.compile(r"resource_exhausted|\b429\b|\brate[ _-]?limit", re.IGNORECASE)
+
+def encode_webp(image_bytes: bytes, quality: int = OUTPUT_WEBP_QUALITY) -> bytes:
+    """Gemini 출력(PNG)을 WebP로 재인코딩. 사진 이미지는 보통 PNG보다 훨씬 작음."""
+    buf = BytesIO()
+    Image.open(BytesIO(image_bytes)).save(buf, format="WEBP", quality=quality)
+    return buf.getvalue()
+
+def lossy_suffix(image_bytes: bytes) -> Optional[str]:
+    """이미 손실 압축된 출력(JPEG/WebP)이면 확장자를 반환 — 재인코딩 없이 그대로 저장. 그 외(PNG 등)는 None."""
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
 def _parse_retry_delay_seconds(err: Exception) -> Optional[int]:
-    m = re.search(r'"retryDelay"\s*:\s*"(\d+)s"', str(err))
+    m = _RETRY_DELAY_RE.search(str(err))
     return int(m.group(1)) if m else None
 
 def is_quota_error(err: Exception) -> bool:
-    s = str(err)
-    return ("RESOURCE_EXHAUSTED" in s) or ("429" in s) or ("rate" in s.lower())
-
-def _sleep_until_min_interval():
-    """컷 사이 최소 간격 확보하되, 최대 3초까지만 기다림(UX 보호)."""
-    global _last_call_ts
-    now = time.time()
-    elapsed = now - _last_call_ts
-    remaining = MIN_INTERVAL_BETWEEN_CALLS_SEC - elapsed
-    if remaining > 0:
-        remaining = min(remaining, 3)  # 캡: 3초
-        time.sleep(remaining + random.uniform(0.1, 0.3))
-
-def _update_last_call_ts():
-    global _last_call_ts
-    _last_call_ts = time.time()
-
-def downscale_max_side(img: Image.Image, max_side: int = 768) -> Image.Image:
-    """최대 변 길이를 제한해 토큰/비용을 줄임."""
-    w, h = img.size
-    scale = max(w, h) / max_side
-    if scale > 1:
-        img = img.resize((int(w / scale), int(h / scale)), Image.LANCZOS)
+    return _QUOTA_RE.search(str(err)) is not None
+
+def _retry_after_from_headers(err: Exception) -> Optional[float]:
+    """google-genai APIError 의 HTTP 응답 헤더(retry-after / x-ratelimit-*)에서 대기 시간을 읽음."""
+    headers = getattr(getattr(err, "response", None), "headers", None)
+    if not headers:
+        return None
+    retry_after = headers.get("retry-after")
+    if retry_after and retry_after.strip().isdigit():
+        return float(retry_after)
+    if headers.get("x-ratelimit-remaining-requests") == "0":
+        return float(MIN_INTERVAL_BETWEEN_CALLS_SEC)
+    return None
+
+class AsyncRateLimiter:
+    """슬라이딩 윈도우 RPM 리미터. 대기는 await asyncio.sleep 으로 하여 이벤트 루프를 막지 않음."""
+
+    def __init__(self, max_calls: int, window_sec: float = 60.0):
+        self.max_calls = max_calls
+        self.window_sec = window_sec
+        self._calls: deque = deque()   # 최근 호출 시각(monotonic)
+        self._lock = asyncio.Lock()
+        self._blocked_until = 0.0      # 서버가 알려준 재시도 시각까지 전체 보류
+
+    async def acquire(self, deadline: Optional[float] = None) -> float:
+        """호출 1회분을 확보하고 기록한 시각을 반환. deadline(monotonic)까지 확보할 수 없으면 기록 없이 TimeoutError."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.window_sec:
+                    self._calls.popleft()
+                wait = self._blocked_until - now
+                if len(self._calls) >= self.max_calls:
+                    wait = max(wait, self._calls[0] + self.window_sec - now)
+                if wait <= 0:
+                    break
+                if deadline is not None and now + wait > deadline:
+                    raise asyncio.TimeoutError()
+                await asyncio.sleep(wait)
+            self._calls.append(now)
+            return now
+
+    def refund(self, stamp: float):
+        """acquire()로 확보했지만 호출하지 않은 1회분을 되돌림."""
+        try:
+            self._calls.remove(stamp)
+        except ValueError:
+            pass  # 이미 윈도우 밖으로 밀려난 기록
+
+    def block_for(self, seconds: float):
+        """429 응답 등으로 알게 된 대기 시간만큼 이후 호출을 보류(반응형 백오프)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+_RATE_LIMITER = AsyncRateLimiter(GEMINI_RPM)
+
+class ClientRateLimiters:
+    """클라이언트(IP)별 AsyncRateLimiter. 전역 리미터 앞단에서 한 사용자의 연속 요청이 다른 사용자를 막지 않게 함.
+    최근에 쓰인 max_clients개만 유지(LRU)."""
+
+    def __init__(self, max_calls: int, max_clients: int, window_sec: float = 60.0):
+        self.max_calls = max_calls
+        self.max_clients = max_clients
+        self.window_sec = window_sec
+        self._limiters: "OrderedDict[str, AsyncRateLimiter]" = OrderedDict()
+
+    def get(self, client_key: str) -> AsyncRateLimiter:
+        limiter = self._limiters.get(client_key)
+        if limiter is None:
+            limiter = self._limiters[client_key] = AsyncRateLimiter(self.max_calls, self.window_sec)
+            if len(self._limiters) > self.max_clients:
+                self._limiters.popitem(last=False)
+        else:
+            self._limiters.move_to_end(client_key)
+        return limiter
+
+_CLIENT_LIMITERS = ClientRateLimiters(GEMINI_RPM_PER_CLIENT, MAX_TRACKED_CLIENTS)
+
+def _is_backpressure_error(err: BaseException) -> bool:
+    """동시성 한도를 줄여야 하는 오류: 429/쿼터, 5xx 게이트웨이 오류, SDK 전송 타임아웃."""
+    if isinstance(err, requests.exceptions.Timeout):
+        return True  # google-genai 동기 전송(requests)의 연결/읽기 타임아웃
+    return is_quota_error(err) or getattr(err, "code", None) in (502, 503, 504)
+
+class AIMDController:
+    """AIMD 동시성 제어기. 성공하면 한도를 alpha 만큼 늘리고, 과부하 신호에는 beta 배로 줄임."""
+
+    def __init__(self, c_min: int, c_max: int, c_init: int, alpha: float, beta: float,
+                 latency_target_sec: float, window: int):
+        self.c_min, self.c_max = c_min, c_max
+        self.alpha, self.beta = alpha, beta
+        self.latency_target_sec = latency_target_sec
+        self.limit = float(c_init)
+        self.inflight = 0
+        self.successes = 0
+        self.backoffs = 0
+        self._latencies: deque = deque(maxlen=window)
+        self._waiters: List[asyncio.Future] = []
+
+    def mean_latency(self) -> Optional[float]:
+        return sum(self._latencies) / len(self._latencies) if self._latencies else None
+
+    async def _acquire(self):
+        while self.inflight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.remove(waiter)
+        self.inflight += 1
+
+    def _release(self, latency: float, ok: bool, backpressure: bool):
+        self.inflight -= 1
+        self._latencies.append(latency)
+        mean = self.mean_latency()
+        if backpressure or (mean is not None and mean > self.latency_target_sec):
+            self.limit = max(self.c_min, self.limit * self.beta)
+            self.backoffs += 1
+        elif ok:
+            self.limit = min(self.c_max, self.limit + self.alpha)
+            self.successes += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[float] = None):
+        """동시 호출 한도 안에서 한 번의 호출을 실행하고, 결과로 한도를 조정.
+
+        deadline(monotonic)을 넘겨 취소된 호출만 과부하로 봄. 클라이언트 연결 종료 등 그 밖의 취소는 무시.
+        """
+        await self._acquire()
+        start = time.monotonic()
+        ok, backpressure = False, False
+        try:
+            yield
+            ok = True
+        except asyncio.CancelledError:
+            backpressure = deadline is not None and time.monotonic() >= deadline
+            raise
+        except BaseException as e:
+            backpressure = _is_backpressure_error(e)
+            raise
+        finally:
+            self._release(time.monotonic() - start, ok, backpressure)
+
+    def snapshot(self) -> dict:
+        mean = self.mean_latency()
+        return {
+            "concurrency_limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "waiting": len(self._waiters),
+            "mean_latency_sec": round(mean, 3) if mean is not None else None,
+            "successes": self.successes,
+            "backoffs": self.backoffs,
+        }
+
+_AIMD = AIMDController(AIMD_MIN_CONCURRENCY, AIMD_MAX_CONCURRENCY, AIMD_INITIAL_CONCURRENCY,
+                       AIMD_ALPHA, AIMD_BETA, AIMD_LATENCY_TARGET_SEC, AIMD_LATENCY_WINDOW)
+
+def result_cache_namespace(scene_label: str, prompt: str) -> str:
+    """모델 + 장면 + 최종 프롬프트. 프롬프트/모델이 바뀌면 이전 결과는 자동으로 무효화됨."""
+    h = hashlib.blake2b(GEMINI_MODEL.encode("utf-8"))
+    h.update(scene_label.encode("utf-8"))
+    h.update(hashlib.blake2b(prompt.encode("utf-8")).digest())
+    return h.hexdigest()
+
+def result_cache_key(ref_digests: List[bytes], namespace: str) -> str:
+    """네임스페이스 + 참조 사진 집합(순서 무관)으로 정확 일치 캐시 키를 만듦."""
+    h = hashlib.blake2b(namespace.encode("utf-8"))
+    h.update(b"".join(sorted(ref_digests)))
+    return h.hexdigest()
+
+def ref_dhash(img: Image.Image) -> int:
+    """64비트 dHash: 9x8 흑백으로 줄여 가로 인접 픽셀 밝기를 비교. 재압축/리사이즈에는 거의 변하지 않음."""
+    px = img.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            bits = (bits << 1) | (px[col] > px[col + 1])
+    return bits
+
+def _dhashes_close(a: Tuple[int, ...], b: Tuple[int, ...], max_distance: int) -> bool:
+    """참조 사진 수가 같고, 모든 사진이 서로 다른 상대와 max_distance 이내로 짝지어지면 True."""
+    if len(a) != len(b):
+        return False
+    unmatched = list(b)
+    for x in a:
+        for i, y in enumerate(unmatched):
+            if (x ^ y).bit_count() <= max_distance:
+                del unmatched[i]
+                break
+        else:
+            return False
+    return True
+
+@dataclass(frozen=True, slots=True)
+class ResultKey:
+    exact: str                          # result_cache_key() — 정확 일치 조회용
+    namespace: str                      # result_cache_namespace() — 유사 중복은 같은 네임스페이스 안에서만
+    ref_dhashes: Tuple[int, ...] = ()   # 참조 사진 dHash (유사 중복 비활성 시 비움)
+
+class ResultCache:
+    """캐시 키 → 저장된 결과 이미지 URL. 인덱스는 JSON 파일에 유지하고, 용량 초과 시 SIEVE로 축출.
+    TTL이 지난 항목은 조회 시점에 제거. 참조 dHash를 함께 기록하면 유사 중복 조회(find_similar)도 가능."""
+
+    def __init__(self, index_path: str, max_bytes: int, ttl_sec: float):
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        # 삽입 순서 = SIEVE 큐(오래된 것 → 최근 것). 값: {"url", "size", "created", "ns", "dhashes", "visited"}
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._hand: Optional[str] = None
+        self._total_bytes = 0
+        self._io_lock = asyncio.Lock()  # 인덱스 기록 순서 보장
+        self._flushes: set = set()      # 진행 중인 백그라운드 기록 태스크(GC 방지용 참조)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()  # 재시작 후에도 유효해야 하므로 벽시계 기준
+        for key, meta in entries.items():
+            fs_path = self._fs_path(meta["url"])
+            if now - meta.get("created", 0) >= self.ttl_sec:
+                try:
+                    os.remove(fs_path)
+                except OSError:
+                    pass
+            elif os.path.exists(fs_path):
+                self._entries[key] = {"url": meta["url"], "size": meta["size"], "created": meta["created"],
+                                      "ns": meta.get("ns", ""), "dhashes": tuple(meta.get("dhashes", ())),
+                                      "visited": False}
+                self._total_bytes += meta["size"]
+
+    def _write_index(self, snapshot: dict, doomed_paths: List[str]):
+        """스레드풀에서 실행: 인덱스 JSON 원자적 기록 + 축출된 파일 삭제."""
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.index_path)
+        for path in doomed_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _fs_path(url: str) -> str:
+        return os.path.join(STATIC_DIR, url.rsplit("/", 1)[-1])
+
+    def get(self, key: str) -> Optional[str]:
+        meta = self._entries.get(key)
+        if meta is None:
+            return None
+        if time.time() - meta["created"] >= self.ttl_sec:
+            self._schedule_flush([self._remove(key)])
+            return None
+        if not os.path.exists(self._fs_path(meta["url"])):  # 외부에서 지워진 경우
+            self._remove(key)
+            return None
+        meta["visited"] = True
+        return meta["url"]
+
+    def find_similar(self, namespace: str, ref_dhashes: Tuple[int, ...], max_distance: int) -> Optional[str]:
+        """같은 네임스페이스에서 참조 사진들이 모두 dHash 거리 이내인 결과를 찾음(선형 탐색, 항목 수천 개 수준)."""
+        for key, meta in list(self._entries.items()):
+            if meta["ns"] == namespace and _dhashes_close(ref_dhashes, meta["dhashes"], max_distance):
+                url = self.get(key)
+                if url is not None:
+                    return url
+        return None
+
+    def lookup(self, key: ResultKey) -> Optional[str]:
+        url = self.get(key.exact)
+        if url is None and key.ref_dhashes:
+            url = self.find_similar(key.namespace, key.ref_dhashes, RESULT_CACHE_NEAR_DUP_MAX_DISTANCE)
+        return url
+
+    def put(self, key: ResultKey, url: str, size: int):
+        """메모리 인덱스는 즉시 갱신하고, 디스크 작업(인덱스 기록/파일 삭제)은 백그라운드 태스크로 넘김.
+        응답(타일 전송)은 기록/삭제를 기다리지 않음."""
+        doomed_paths = []
+        if key.exact in self._entries:
+            self._retire(key.exact)
+        # 새 항목을 넣기 전에 축출 — 방문 비트가 모두 켜져 있어도 방금 저장한 결과가 축출되지 않음
+        while self._entries and self._total_bytes + size > self.max_bytes:
+            doomed_paths.append(self._evict_one())
+        self._entries[key.exact] = {"url": url, "size": size, "created": time.time(),
+                                    "ns": key.namespace, "dhashes": key.ref_dhashes, "visited": False}
+        self._total_bytes += size
+        self._schedule_flush(doomed_paths)
+
+    def _schedule_flush(self, doomed_paths: List[str]):
+        snapshot = {k: {"url": m["url"], "size": m["size"], "created": m["created"],
+                        "ns": m["ns"], "dhashes": list(m["dhashes"])}
+                    for k, m in self._entries.items()}
+        task = asyncio.get_running_loop().create_task(self._flush(snapshot, doomed_paths))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, snapshot: dict, doomed_paths: List[str]):
+        async with self._io_lock:
+            try:
+                await asyncio.to_thread(self._write_index, snapshot, doomed_paths)
+            except OSError:
+                pass  # 인덱스 기록 실패는 다음 put 때 다시 기록됨
+
+    def _remove(self, key: str) -> str:
+        """메모리 인덱스에서 제거하고 해당 파일 경로를 반환(삭제는 호출부 몫)."""
+        meta = self._entries.pop(key)
+        self._total_bytes -= meta["size"]
+        if self._hand == key:
+            self._hand = None
+        return self._fs_path(meta["url"])
+
+    def _retire(self, key: str):
+        """덮어쓰기 전 기존 항목을 별도 키로 옮김. 이전 URL을 이미 받은 페이지가 있을 수 있으므로
+        파일은 바로 지우지 않고 TTL/축출에 맡김(방문 비트를 꺼 두어 먼저 축출될 후보가 됨)."""
+        meta = self._entries.pop(key)
+        if self._hand == key:
+            self._hand = None
+        meta["visited"] = False
+        self._entries[f"{key}~{uuid.uuid4().hex[:8]}"] = meta
+
+    def _evict_one(self) -> str:
+        """SIEVE: 손(hand)을 오래된 쪽에서 최근 쪽으로 옮기며 방문 비트가 꺼진 첫 항목을 축출."""
+        keys = list(self._entries)
+        i = keys.index(self._hand) if self._hand in self._entries else 0
+        while self._entries[keys[i]]["visited"]:
+            self._entries[keys[i]]["visited"] = False
+            i = (i + 1) % len(keys)
+        doomed_path = self._remove(keys[i])
+        self._hand = keys[i + 1] if i + 1 < len(keys) else None
+        return doomed_path
+
+_RESULT_CACHE = ResultCache(RESULT_CACHE_INDEX_PATH, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SEC)
+
+def downscale_max_side(img: Image.Image, max_side: int = 768,
+                       resample: int = Image.LANCZOS) -> Image.Image:
+    """최대 변 길이를 제한해 토큰/비용을 줄임. thumbnail()로 제자리 축소해 픽셀 복사 1회를 아낌."""
+    img.thumbnail((max_side, max_side), resample)
     return img
 
-def compose_prompt(scene_label: str, scene_desc: str, use_exact_billgates: bool, num_refs: int) -> str:
-    """정체성 유지 지시 강화 + 다중 참조 이미지 활용 프롬프트."""
-    billgates_phrase = (
-        "Bill Gates" if use_exact_billgates
-        else "a Bill Gates look-alike (middle-aged Caucasian male with glasses)"
+def decode_and_resize(data: bytes, max_side: int = 768) -> Tuple[Image.Image, bytes]:
+    """업로드 바이트 → RGB 디코드 + 축소, 축소된 픽셀의 digest와 함께 반환. 스레드풀에서 실행(디코드/리샘플/해시 중 GIL 해제).
+    JPEG는 draft()로 DCT 단계에서 1/2~1/8 축소 디코드 후 BICUBIC으로 마무리."""
+    img = Image.open(BytesIO(data))
+    if img.format == "JPEG":
+        img.draft("RGB", (max_side * 2, max_side * 2))
+        img = downscale_max_side(img.convert("RGB"), max_side=max_side, resample=Image.BICUBIC)
+    else:
+        img = downscale_max_side(img.convert("RGB"), max_side=max_side)
+    return img, hashlib.blake2b(img.tobytes(), digest_size=16).digest()
+
+def encode_reference(img: Image.Image) -> types.Part:
+    """참조 사진을 JPEG로 한 번만 인코딩. 모든 컷 호출이 같은 바이트를 재사용."""
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=85, optimize=True)  # 허프만 테이블 최적화: 수 % 더 작게
+    return types.Part.from_bytes(data=buf.getvalue(), mime_type="image/jpeg")
+
+# ---------- 프롬프트 (장면과 무관한 부분은 import 시 한 번만 조립) ----------
+# 도입부는 출력 장수별로 분리: 묶음 호출에 "single photo" 지시가 섞이면 이미지를 1장만 돌려줌
+_PROMPT_INTRO = "Create a single photorealistic candid smartphone photo of two people.\n"
+_BATCH_PROMPT_INTRO = ("Create a set of separate photorealistic candid smartphone photos of the same two people, "
+                       "one photo per scene listed at the end.\n")
+
+_REF_INSTRUCTIONS = {
+    1: (
+        "PERSON A: The EXACT same individual shown in the uploaded reference selfie. "
+        "ZERO MODIFICATION RULE - SINGLE REFERENCE: When only ONE reference photo is provided, make ABSOLUTELY NO CHANGES to PERSON A. "
+        "PRESERVE EVERYTHING EXACTLY AS SHOWN: "
+        "✓ IDENTICAL facial angle, head position, and neck posture "
+        "✓ EXACT gaze direction and eye focus point "
+        "✓ UNCHANGED facial expression (smile, neutral, etc.) "
+        "✓ PERFECT preservation of ALL eye characteristics (shape, size, iris color, eyelid structure) "
+        "✓ EXACT clothing style, fit, color, and texture from the reference "
+        "✓ IDENTICAL body posture and stance "
+        "✓ UNCHANGED hair style, texture, and any accessories "
+        "✓ EXACT skin tone and lighting on the person "
+        "DO NOT modify, adjust, enhance, or change ANY aspect of PERSON A's appearance. "
+        "Simply place this EXACT person into the new Korean scene without ANY alterations."
+    ),
+    2: (
+        "PERSON A: The same individual shown in BOTH uploaded reference selfies. "
+        "ULTRA-CRITICAL EYE PRESERVATION: Study both references to identify the EXACT eye characteristics and maintain them perfectly."
+    ),
+    3: (
+        "PERSON A: The same individual shown in ALL THREE uploaded reference selfies. "
+        "ULTRA-CRITICAL EYE PRESERVATION: Analyze all three references to extract the most consistent eye features and preserve them exactly."
+    ),
+}
+# 4장 이상: 장수만 바뀜
+_REF_INSTRUCTION_MANY = (
+    "PERSON A: The same individual shown in ALL {num_refs} uploaded reference selfies. "
+    "ULTRA-CRITICAL EYE PRESERVATION: Comprehensively analyze all references to identify the person's true eye characteristics and maintain them with absolute precision."
+)
+
+_PROMPT_IDENTITY_RULES = (
+    "ABSOLUTE MAXIMUM IDENTITY PRESERVATION - ULTIMATE PRIORITY: PERSON A must be PERFECTLY PRESERVED with 100% accuracy in ALL aspects. "
+    "SINGLE REFERENCE SPECIAL RULE: If only ONE reference photo is provided, treat it as a PERFECT TEMPLATE that must NOT be modified in ANY way. "
+    "Simply transplant this EXACT person into the Korean scene with ZERO changes to face, body, clothing, or pose. "
+    "COMPREHENSIVE MULTI-REFERENCE ANALYSIS: Study ALL uploaded reference images with extreme precision to identify the person's TRUE identity. "
+    "Extract the MOST RELIABLE and CONSISTENT features across ALL references, ignoring lighting/angle variations.\n"
+    "MANDATORY PRESERVATION CHECKLIST - FACIAL FEATURES (CRITICAL FOR SINGLE REFERENCE):\n"
+    "✓ EXACT bone structure and facial geometry (jaw shape, cheekbone prominence, forehead shape)\n"
+    "✓ ULTRA-PRECISE EYE CHARACTERISTICS - HIGHEST PRIORITY:\n"
+    "  • EXACT eye shape and size (round, almond, hooded, etc.)\n"
+    "  • IDENTICAL eye spacing and positioning relative to nose bridge\n"
+    "  • PERFECT eyelid structure (upper/lower lid fold patterns, thickness)\n"
+    "  • EXACT iris color, size, and pupil characteristics\n"
+    "  • IDENTICAL eyebrow shape, thickness, arch, and positioning\n"
+    "  • PRECISE eye corner shape (inner/outer canthus angles)\n"
+    "  • EXACT under-eye area characteristics (bags, lines, shadows)\n"
+    "  • IDENTICAL eye expression and natural resting position\n"
+    "✓ IDENTICAL nose features (bridge width, nostril shape, tip angle, overall proportions)\n"
+    "✓ EXACT mouth and lip characteristics (shape, size, cupid's bow, lip thickness)\n"
+    "✓ PERFECT facial proportions (eye-to-nose, nose-to-mouth ratios)\n"
+    "✓ CONSISTENT skin tone (match the most representative tone across all references)\n"
+    "✓ IDENTICAL age appearance and facial maturity level\n"
+    "✓ ALL distinctive marks (moles, freckles, scars, dimples) in EXACT positions\n"
+    "✓ HAIR style and color from the clearest/most recent reference\n"
+    "MANDATORY PRESERVATION CHECKLIST - BODY & PHYSIQUE (CRITICAL FOR SINGLE REFERENCE):\n"
+    "✓ EXACT body proportions and build type (slim, athletic, muscular, etc.)\n"
+    "✓ IDENTICAL height proportions relative to the scene\n"
+    "✓ CONSISTENT shoulder width and posture characteristics\n"
+    "✓ MATCHING body shape and overall physique from reference images\n"
+    "✓ PRESERVE natural body language and movement patterns visible in references\n"
+    "✓ MAINTAIN consistent body type throughout all generated scenes\n"
+    "MANDATORY PRESERVATION CHECKLIST - CLOTHING & STYLE (CRITICAL FOR SINGLE REFERENCE):\n"
+    "✓ ANALYZE clothing style and fashion preferences from ALL reference images\n"
+    "✓ MAINTAIN consistent personal style aesthetic (casual, formal, sporty, trendy, etc.)\n"
+    "✓ PRESERVE color palette preferences shown in reference clothing\n"
+    "✓ MATCH clothing fit and silhouette preferences (loose, fitted, oversized, etc.)\n"
+    "✓ KEEP accessory style consistent (glasses style, jewelry preferences, etc.)\n"
+    "✓ ADAPT reference clothing style appropriately to the new scene while maintaining personal aesthetic\n"
+    "ULTRA-CRITICAL INSTRUCTION FOR SINGLE REFERENCE: When only ONE reference photo is provided, this is a PERFECT TEMPLATE. "
+    "DO NOT change, modify, adjust, or enhance ANY aspect of PERSON A's appearance, facial features, clothing, or pose. "
+    "The reference image represents the EXACT desired appearance that must be preserved completely. "
+    "Simply place this IDENTICAL person into the Korean scene background while keeping ALL aspects of their appearance UNCHANGED. "
+    "Think of it as copying and pasting the person exactly as they are into a new background.\n"
+    "ULTRA-CRITICAL INSTRUCTION FOR MULTIPLE REFERENCES: Analyze ALL reference images to determine the person's CONSISTENT body type and physique. "
+    "If references show variations due to clothing or angles, prioritize the MOST REPRESENTATIVE body characteristics. "
+    "NEVER alter or idealize the person's natural body proportions - maintain their authentic physique exactly as shown. "
+    "EYE CONSISTENCY ULTRA-PRIORITY: The eyes are the most important feature for identity recognition. "
+    "Study each reference image to identify the EXACT eye characteristics that remain consistent across different angles and lighting. "
+    "For single reference: maintain EXACT eye angle, gaze direction, and expression. "
+    "For multiple references: identify the MOST RELIABLE eye features that appear consistently. "
+    "Never modify eye shape, size, color, or spacing - these are identity-defining characteristics. "
+    "Pay special attention to: eye symmetry, pupil size, iris patterns, eyelash density, and natural eye expression. "
+    "CLOTHING ADAPTATION RULES: Study the clothing styles in ALL reference images to understand the person's fashion preferences. "
+    "Adapt their clothing style to the scene while maintaining their personal aesthetic - if they wear casual clothes, keep it casual; "
+    "if they prefer fitted clothing, maintain that preference; if they like certain colors or patterns, incorporate similar elements. "
+    "The outfit should feel natural for that person while being appropriate for the Korean scene. "
+    "The generated person must be INSTANTLY recognizable as the SAME individual from the references in face, body, AND personal style, "
+    "even by people who know them personally. The underlying facial structure, body type, and style identity must remain COMPLETELY UNCHANGED.\n"
+)
+
+_PROMPT_CAMERA_RULES = (
+    "Camera: Professional smartphone photography, ~35mm equivalent, perfect natural lighting with studio-quality shadows, "
+    "flawless hand/finger anatomy, premium casual outfits appropriate for the scene. Both people should look naturally candid "
+    "yet cinematically composed with magazine-quality aesthetics.\n"
+    "TECHNICAL REQUIREMENTS: Ultra-high resolution details, perfect skin texture, natural color grading, professional depth of field, "
+    "studio-quality lighting that enhances facial features without harsh shadows.\n"
+    "ABSOLUTELY NO TEXT, LABELS, OR OVERLAYS: Do not include any text, time stamps, location names, captions, watermarks, "
+    "or any written elements in the image. The photo should be completely clean without any textual information. "
+    "No borders, frames, or graphic elements. "
+)
+_SINGLE_OUTPUT_RULE = "Only one pristine, text-free image in the result."
+
+def _prompt_prefix(character_type: str, use_exact_billgates: bool, num_refs: int) -> str:
+    """장면과 무관한 프롬프트 앞부분(참조 장수별 지시 + 정체성 규칙 + PERSON B + 촬영 지시). 도입부는 호출부가 붙임.
+    컷마다 같은 접두부로 두어 Gemini 암묵적 캐시가 적중하게 하고, 장면은 맨 끝에 붙임."""
+    cfg = CHARACTERS[character_type]
+    person_b = cfg.exact_phrase if use_exact_billgates else cfg.lookalike_phrase
+    ref_instruction = _REF_INSTRUCTIONS.get(num_refs) or _REF_INSTRUCTION_MANY.format(num_refs=num_refs)
+    return (
+        f"{ref_instruction} {_PROMPT_IDENTITY_RULES}"
+        f"PERSON B: {person_b}.\n"
+        f"{_PROMPT_CAMERA_RULES}"
     )
-    
-    ref_instruction = ""
-    if num_refs == 1:
-        ref_instruction = ("PERSON A: The EXACT same individual shown in the uploaded reference selfie. "
-                         "ZERO MODIFICATION RULE - SINGLE REFERENCE: When only ONE reference photo is provided, make ABSOLUTELY NO CHANGES to PERSON A. "
-                         "PRESERVE EVERYTHING EXACTLY AS SHOWN: "
-                         "✓ IDENTICAL facial angle, head position, and neck posture "
-                         "✓ EXACT gaze direction and eye focus point "
-                         "✓ UNCHANGED facial expression (smile, neutral, etc.) "
-                         "✓ PERFECT preservation of ALL eye characteristics (shape, size, iris color, eyelid structure) "
-                         "✓ EXACT clothing style, fit, color, and texture from the reference "
-                         "✓ IDENTICAL body posture and stance "
-                         "✓ UNCHANGED hair style, texture, and any accessories "
-                         "✓ EXACT skin tone and lighting on the person "
-                         "DO NOT modify, adjust, enhance, or change ANY aspect of PERSON A's appearance. "
-                         "Simply place this EXACT person into the new Korean scene without ANY alterations.")
-    elif num_refs == 2:
-        ref_instruction = ("PERSON A: The same individual shown in BOTH uploaded reference selfies. "
-                         "ULTRA-CRITICAL EYE PRESERVATION: Study both references to identify the EXACT eye characteristics and maintain them perfectly.")
-    elif num_refs == 3:
-        ref_instruction = ("PERSON A: The same individual shown in ALL THREE uploaded reference selfies. "
-                         "ULTRA-CRITICAL EYE PRESERVATION: Analyze all three references to extract the most consistent eye features and preserve them exactly.")
-    else:  # 4장 이상
-        ref_instruction = (f"PERSON A: The same individual shown in ALL {num_refs} uploaded reference selfies. "
-                         "ULTRA-CRITICAL EYE PRESERVATION: Comprehensively analyze all references to identify the person's true eye characteristics and maintain them with absolute precision.")
-    
+
+PROMPT_PREFIX = {
+    (character_type, use_exact, num_refs): _prompt_prefix(character_type, use_exact, num_refs)
+    for character_type in CHARACTERS
+    for use_exact in (True, False)
+    for num_refs in _REF_INSTRUCTIONS
+}
+
+def compose_prompt(scene_label: str, scene_desc: str, use_exact_billgates: bool, num_refs: int,
+                   character_type: str = DEFAULT_CHARACTER) -> str:
+    """정체성 유지 지시 강화 + 다중 참조 이미지 활용 프롬프트. 미리 조립한 접두부(촬영 지시 포함) + 장면 설명."""
+    # lru_cache는 위치/키워드 인자 조합마다 키가 달라지므로 항상 위치 인자로 넘겨 한 키로 모음
+    return _compose_prompt(scene_label, scene_desc, use_exact_billgates, num_refs, character_type)
+
+@lru_cache(maxsize=64)  # 인자가 모두 hashable한 순수 함수: 장면 × 옵션 × 참조 수 조합만큼만 쌓임
+def _compose_prompt(scene_label: str, scene_desc: str, use_exact_billgates: bool, num_refs: int,
+                    character_type: str) -> str:
+    key = (character_type, use_exact_billgates, num_refs)
+    prefix = PROMPT_PREFIX.get(key) or _prompt_prefix(*key)
+    return f"{_PROMPT_INTRO}{prefix}{_SINGLE_OUTPUT_RULE}\nScene: {scene_desc} in Seoul, Korea."
+
+def compose_batch_prompt(scenes: List[Tuple[str, str]], use_exact_billgates: bool, num_refs: int,
+                         character_type: str = DEFAULT_CHARACTER) -> str:
+    """여러 장면을 한 번에 요청하는 프롬프트. 장면 순서대로 이미지 1장씩을 요구."""
+    key = (character_type, use_exact_billgates, num_refs)
+    prefix = PROMPT_PREFIX.get(key) or _prompt_prefix(*key)
+    scene_lines = "".join(f"Scene {n}: {desc} in Seoul, Korea.\n" for n, (_, desc) in enumerate(scenes, 1))
     return (
-        "Create a single photorealistic candid smartphone photo of two people.\n"
-        f"{ref_instruction} "
-        "ABSOLUTE MAXIMUM IDENTITY PRESERVATION - ULTIMATE PRIORITY: PERSON A must be PERFECTLY PRESERVED with 100% accuracy in ALL aspects. "
-        "SINGLE REFERENCE SPECIAL RULE: If only ONE reference photo is provided, treat it as a PERFECT TEMPLATE that must NOT be modified in ANY way. "
-        "Simply transplant this EXACT person into the Korean scene with ZERO changes to face, body, clothing, or pose. "
-        "COMPREHENSIVE MULTI-REFERENCE ANALYSIS: Study ALL uploaded reference images with extreme precision to identify the person's TRUE identity. "
-        "Extract the MOST RELIABLE and CONSISTENT features across ALL references, ignoring lighting/angle variations.\n"
-        "MANDATORY PRESERVATION CHECKLIST - FACIAL FEATURES (CRITICAL FOR SINGLE REFERENCE):\n"
-        "✓ EXACT bone structure and facial geometry (jaw shape, cheekbone prominence, forehead shape)\n"
-        "✓ ULTRA-PRECISE EYE CHARACTERISTICS - HIGHEST PRIORITY:\n"
-        "  • EXACT eye shape and size (round, almond, hooded, etc.)\n"
-        "  • IDENTICAL eye spacing and positioning relative to nose bridge\n"
-        "  • PERFECT eyelid structure (upper/lower lid fold patterns, thickness)\n"
-        "  • EXACT iris color, size, and pupil characteristics\n"
-        "  • IDENTICAL eyebrow shape, thickness, arch, and positioning\n"
-        "  • PRECISE eye corner shape (inner/outer canthus angles)\n"
-        "  • EXACT under-eye area characteristics (bags, lines, shadows)\n"
-        "  • IDENTICAL eye expression and natural resting position\n"
-        "✓ IDENTICAL nose features (bridge width, nostril shape, tip angle, overall proportions)\n"
-        "✓ EXACT mouth and lip characteristics (shape, size, cupid's bow, lip thickness)\n"
-        "✓ PERFECT facial proportions (eye-to-nose, nose-to-mouth ratios)\n"
-        "✓ CONSISTENT skin tone (match the most representative tone across all references)\n"
-        "✓ IDENTICAL age appearance and facial maturity level\n"
-        "✓ ALL distinctive marks (moles, freckles, scars, dimples) in EXACT positions\n"
-        "✓ HAIR style and color from the clearest/most recent reference\n"
-        "MANDATORY PRESERVATION CHECKLIST - BODY & PHYSIQUE (CRITICAL FOR SINGLE REFERENCE):\n"
-        "✓ EXACT body proportions and build type (slim, athletic, muscular, etc.)\n"
-        "✓ IDENTICAL height proportions relative to the scene\n"
-        "✓ CONSISTENT shoulder width and posture characteristics\n"
-        "✓ MATCHING body shape and overall physique from reference images\n"
-        "✓ PRESERVE natural body language and movement patterns visible in references\n"
-        "✓ MAINTAIN consistent body type throughout all generated scenes\n"
-        "MANDATORY PRESERVATION CHECKLIST - CLOTHING & STYLE (CRITICAL FOR SINGLE REFERENCE):\n"
-        "✓ ANALYZE clothing style and fashion preferences from ALL reference images\n"
-        "✓ MAINTAIN consistent personal style aesthetic (casual, formal, sporty, trendy, etc.)\n"
-        "✓ PRESERVE color palette preferences shown in reference clothing\n"
-        "✓ MATCH clothing fit and silhouette preferences (loose, fitted, oversized, etc.)\n"
-        "✓ KEEP accessory style consistent (glasses style, jewelry preferences, etc.)\n"
-        "✓ ADAPT reference clothing style appropriately to the new scene while maintaining personal aesthetic\n"
-        "ULTRA-CRITICAL INSTRUCTION FOR SINGLE REFERENCE: When only ONE reference photo is provided, this is a PERFECT TEMPLATE. "
-        "DO NOT change, modify, adjust, or enhance ANY aspect of PERSON A's appearance, facial features, clothing, or pose. "
-        "The reference image represents the EXACT desired appearance that must be preserved completely. "
-        "Simply place this IDENTICAL person into the Korean scene background while keeping ALL aspects of their appearance UNCHANGED. "
-        "Think of it as copying and pasting the person exactly as they are into a new background.\n"
-        "ULTRA-CRITICAL INSTRUCTION FOR MULTIPLE REFERENCES: Analyze ALL reference images to determine the person's CONSISTENT body type and physique. "
-        "If references show variations due to clothing or angles, prioritize the MOST REPRESENTATIVE body characteristics. "
-        "NEVER alter or idealize the person's natural body proportions - maintain their authentic physique exactly as shown. "
-        "EYE CONSISTENCY ULTRA-PRIORITY: The eyes are the most important feature for identity recognition. "
-        "Study each reference image to identify the EXACT eye characteristics that remain consistent across different angles and lighting. "
-        "For single reference: maintain EXACT eye angle, gaze direction, and expression. "
-        "For multiple references: identify the MOST RELIABLE eye features that appear consistently. "
-        "Never modify eye shape, size, color, or spacing - these are identity-defining characteristics. "
-        "Pay special attention to: eye symmetry, pupil size, iris patterns, eyelash density, and natural eye expression. "
-        "CLOTHING ADAPTATION RULES: Study the clothing styles in ALL reference images to understand the person's fashion preferences. "
-        "Adapt their clothing style to the scene while maintaining their personal aesthetic - if they wear casual clothes, keep it casual; "
-        "if they prefer fitted clothing, maintain that preference; if they like certain colors or patterns, incorporate similar elements. "
-        "The outfit should feel natural for that person while being appropriate for the Korean scene. "
-        "The generated person must be INSTANTLY recognizable as the SAME individual from the references in face, body, AND personal style, "
-        "even by people who know them personally. The underlying facial structure, body type, and style identity must remain COMPLETELY UNCHANGED.\n"
-        f"PERSON B: {billgates_phrase}.\n"
-        f"Scene: {scene_desc} in Seoul, Korea.\n"
-        "Camera: Professional smartphone photography, ~35mm equivalent, perfect natural lighting with studio-quality shadows, "
-        "flawless hand/finger anatomy, premium casual outfits appropriate for the scene. Both people should look naturally candid "
-        "yet cinematically composed with magazine-quality aesthetics.\n"
-        "TECHNICAL REQUIREMENTS: Ultra-high resolution details, perfect skin texture, natural color grading, professional depth of field, "
-        "studio-quality lighting that enhances facial features without harsh shadows.\n"
-        "ABSOLUTELY NO TEXT, LABELS, OR OVERLAYS: Do not include any text, time stamps, location names, captions, watermarks, "
-        "or any written elements in the image. The photo should be completely clean without any textual information. "
-        "No borders, frames, or graphic elements. Only one pristine, text-free image in the result."
+        f"{_BATCH_PROMPT_INTRO}{prefix}Generate {len(scenes)} distinct photos of the same two people, one per scene below, in order.\n"
+        f"Return exactly {len(scenes)} separate pristine, text-free images, one per scene, in the same order.\n"
+        f"{scene_lines}"
     )
 
-def call_gemini_generate(ref_images: List[Image.Image], prompt: str) -> bytes:
-    """Gemini 호출: 참조 사진(다중)을 먼저, 프롬프트를 나중에. 후보 1개(기본). 빠른 실패/짧은 백오프."""
-    client = genai.Client(api_key=API_KEY)
-    model_name = "gemini-2.5-flash-image-preview"  # 최고 성능 모델
+@dataclass(frozen=True, slots=True)
+class CallContext:
+    """한 /generate 요청의 모든 Gemini 호출이 공유하는 값."""
+    deadline: float                                     # 요청 전체 마감 시각 (time.monotonic 기준)
+    client_limiter: Optional[AsyncRateLimiter] = None   # 클라이언트(IP)별 리미터 — 전역 리미터보다 먼저 통과
+    cached_content: Optional[str] = None                # 참조 사진 컨텍스트 캐시 이름 (있으면 프롬프트만 전송)
 
-    # contents 구성: [ref1, ref2, ref3, ..., prompt]
-    contents = []
-    for im in ref_images:
-        contents.append(im)
-    contents.append(prompt)
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+async def call_gemini_generate_images(ref_parts: List[types.Part], prompt: str,
+                                      ctx: Optional[CallContext] = None) -> List[bytes]:
+    """Gemini 비동기 호출: 참조 사진(다중)을 먼저, 프롬프트를 나중에. 응답의 inline 이미지를 순서대로 모두 반환.
+    빠른 실패/짧은 백오프. 요청 마감까지 MIN_CALL_BUDGET_SEC 미만이면 호출하지 않고 TimeoutError."""
+    # contents 구성: [ref1, ref2, ref3, ..., prompt] (컨텍스트 캐시 사용 시 [prompt])
+    if ctx is not None and ctx.cached_content:
+        contents = [prompt]
+        config = types.GenerateContentConfig(cached_content=ctx.cached_content)
+    else:
+        contents = [*ref_parts, prompt]
+        config = None
 
     last_err = None
-    start_ts = time.time()
 
     for attempt in range(1, MAX_RETRIES_PER_SHOT + 1):
         try:
-            _sleep_until_min_interval()
+            # 남은 시간으로는 끝낼 수 없는 호출은 리미터 슬롯도 쓰지 않고 거절 (쿼터 낭비 방지)
+            start_by, client_stamp = None, None
+            if ctx is not None:
+                start_by = ctx.deadline - MIN_CALL_BUDGET_SEC
+                if time.monotonic() > start_by:
+                    raise asyncio.TimeoutError()
+                if ctx.client_limiter is not None:
+                    client_stamp = await ctx.client_limiter.acquire(start_by)
+            try:
+                await _RATE_LIMITER.acquire(start_by)
+            except BaseException:
+                if client_stamp is not None:  # 전역 리미터에서 거절/취소되면 클라이언트 슬롯도 되돌림
+                    ctx.client_limiter.refund(client_stamp)
+                raise
 
             # NOTE: google-genai 최신 버전은 generation_config 파라미터를 받지 않습니다.
-            response = client.models.generate_content(
-                model=model_name,
-                contents=contents
-            )
-            _update_last_call_ts()
-
-            # 첫 번째 후보의 첫 번째 inline 이미지 한 장만 사용
-            for part in response.candidates[0].content.parts:
-                if getattr(part, "inline_data", None) is not None:
-                    return part.inline_data.data
-            raise RuntimeError("이미지 생성에 실패했습니다(텍스트 응답만 수신).")
+            async with _AIMD.slot(ctx.deadline if ctx is not None else None):
+                response = await GENAI_ASYNC.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=contents,
+                    config=config,
+                )
+
+            # 첫 번째 후보의 inline 이미지들만 사용
+            if not response.candidates or response.candidates[0].content is None:
+                raise RuntimeError("이미지 생성에 실패했습니다(후보 없음 — 안전 필터 차단 가능).")
+            parts = response.candidates[0].content.parts or []
+            images = [p.inline_data.data for p in parts if getattr(p, "inline_data", None) is not None]
+            if not images:
+                raise RuntimeError("이미지 생성에 실패했습니다(텍스트 응답만 수신).")
+            return images
 
         except Exception as e:
             last_err = e
-            _update_last_call_ts()
-
-            if is_quota_error(e) and attempt < MAX_RETRIES_PER_SHOT:
-                delay = _parse_retry_delay_seconds(e) or MIN_INTERVAL_BETWEEN_CALLS_SEC
-                delay = min(delay, 6)  # 너무 오래 기다리지 않도록 캡
-                elapsed = time.time() - start_ts
-                if elapsed + delay > PER_REQUEST_DEADLINE_SEC:
-                    break  # 더 기다리면 타임아웃 위험 → 즉시 실패
-                time.sleep(delay + random.uniform(0.2, 0.8))
+            if not is_quota_error(e):
+                break
+
+            # 서버가 알려준 대기 시간은 다른 요청의 호출에도 반영
+            server_delay = _retry_after_from_headers(e) or _parse_retry_delay_seconds(e)
+            if server_delay:
+                _RATE_LIMITER.block_for(server_delay)
+
+            if attempt < MAX_RETRIES_PER_SHOT:
+                delay = min(server_delay or MIN_INTERVAL_BETWEEN_CALLS_SEC, 6)  # 너무 오래 기다리지 않도록 캡
+                # 데드라인은 호출부의 asyncio.wait_for 가 보장
+                await asyncio.sleep(delay + random.uniform(0.2, 0.8))
                 continue
             break
 
     raise last_err
 
+async def call_gemini_generate(ref_parts: List[types.Part], prompt: str,
+                               ctx: Optional[CallContext] = None) -> bytes:
+    """한 컷 호출. 응답의 첫 번째 inline 이미지 한 장만 사용."""
+    images = await call_gemini_generate_images(ref_parts, prompt, ctx)
+    return images[0]
+
+async def generate_scene(scene_label: str, scene_desc: str, ref_parts: List[types.Part],
+                         exact_billgates: bool, character_type: str = DEFAULT_CHARACTER,
+                         ctx: Optional[CallContext] = None) -> bytes:
+    """한 컷 생성. 429/쿼터는 그대로 실패, 정책/콘텐츠 이슈 추정 시 look-alike로 1회 재시도."""
+    prompt = compose_prompt(scene_label, scene_desc, use_exact_billgates=exact_billgates,
+                            num_refs=len(ref_parts), character_type=character_type)
+    try:
+        return await call_gemini_generate(ref_parts, prompt, ctx)
+    except asyncio.TimeoutError:
+        raise  # 마감 초과: 폴백해도 시간 안에 끝낼 수 없음
+    except Exception as e1:
+        # 429/쿼터: 페일오버도 하지 않고 실패 기록
+        if is_quota_error(e1) or not (exact_billgates and CHARACTERS[character_type].allow_lookalike_fallback):
+            raise
+        fallback_prompt = compose_prompt(scene_label, scene_desc, use_exact_billgates=False,
+                                         num_refs=len(ref_parts), character_type=character_type)
+        return await call_gemini_generate(ref_parts, fallback_prompt, ctx)
+
+async def generate_and_save(scene_label: str, scene_desc: str, ref_parts: List[types.Part],
+                            exact_billgates: bool, character_type: str, cache_key: ResultKey,
+                            ctx: CallContext) -> Tuple[Optional[str], Optional[str]]:
+    """요청 공통 마감 안에서 한 컷을 생성·저장하고 (이미지 URL, 오류 메시지) 중 하나를 채워 반환."""
+    try:
+        if ctx.remaining() < MIN_CALL_BUDGET_SEC:
+            raise asyncio.TimeoutError()
+        img_bytes = await asyncio.wait_for(
+            generate_scene(scene_label, scene_desc, ref_parts, exact_billgates, character_type, ctx),
+            timeout=ctx.remaining(),
+        )
+        # 디코드할 수 없는 출력 등 저장 실패도 이 컷의 오류로 기록 (다른 컷/페이지는 계속)
+        return await save_result(img_bytes, cache_key), None
+    except asyncio.TimeoutError:
+        return None, f"{scene_label}: 실패 — 시간 초과({PER_REQUEST_DEADLINE_SEC}초)"
+    except Exception as e:
+        return None, f"{scene_label}: 실패 — {e}"
+
+async def save_result(img_bytes: bytes, cache_key: ResultKey) -> str:
+    """결과 저장 (워터마크 없음, PNG만 스레드풀에서 WebP로 인코딩) 후 캐시에 등록하고 URL 반환."""
+    suffix = lossy_suffix(img_bytes)
+    if suffix is None:
+        img_bytes, suffix = await asyncio.to_thread(encode_webp, img_bytes), ".webp"
+    saved_url = await save_image_bytes(img_bytes, suffix=suffix)
+    _RESULT_CACHE.put(cache_key, saved_url, len(img_bytes))
+    return saved_url
+
+async def generate_batch_and_save(scenes: List[Tuple[str, str]], ref_parts: List[types.Part],
+                                  exact_billgates: bool, character_type: str,
+                                  cache_keys: List[ResultKey], ctx: CallContext
+                                  ) -> Tuple[List[Optional[str]], Optional[Exception]]:
+    """여러 컷을 한 번의 호출로 생성·저장. 장면별 URL(받지 못한 컷은 None)과 호출 오류를 반환."""
+    prompt = compose_batch_prompt(scenes, exact_billgates, len(ref_parts), character_type)
+    try:
+        images = await asyncio.wait_for(call_gemini_generate_images(ref_parts, prompt, ctx),
+                                        timeout=ctx.remaining())
+    except Exception as e:
+        return [None] * len(scenes), e
+    urls: List[Optional[str]] = [None] * len(scenes)
+    for n, (img_bytes, cache_key) in enumerate(zip(images, cache_keys)):
+        try:
+            urls[n] = await save_result(img_bytes, cache_key)
+        except Exception as e:
+            logger.info("묶음 결과 저장 실패, 컷별 호출로 보충: %s", e)  # None으로 남겨 컷별 호출로 보충
+    return urls, None
+
+# ---------- 명시적 컨텍스트 캐시 (참조 사진 1회 업로드) ----------
+_BACKGROUND_TASKS: set = set()  # 응답과 무관하게 끝까지 실행할 정리 태스크(GC 방지용 참조)
+
+async def create_reference_cache(ref_parts: List[types.Part], timeout: float) -> Optional[str]:
+    """참조 사진만 담은 CachedContent를 만들고 이름을 반환. 실패하면 None(호출부는 인라인 전송)."""
+    try:
+        cache = await asyncio.wait_for(
+            GENAI_ASYNC.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    contents=[types.Content(role="user", parts=ref_parts)],
+                    ttl=f"{CONTEXT_CACHE_TTL_SEC}s",
+                ),
+            ),
+            timeout=timeout,
+        )
+    except Exception as e:
+        logger.info("컨텍스트 캐시 생성 실패, 인라인 전송으로 진행: %s", e)
+        return None
+    return cache.name
+
+async def _delete_reference_cache(name: str):
+    try:
+        await GENAI_ASYNC.caches.delete(name=name)
+    except Exception as e:
+        logger.info("컨텍스트 캐시 삭제 실패(TTL 후 만료): %s", e)
+
+def schedule_reference_cache_delete(name: str):
+    """요청 종료(연결 끊김 포함) 시 캐시 삭제를 백그라운드로 넘김."""
+    task = asyncio.get_running_loop().create_task(_delete_reference_cache(name))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
 # ---------- HTML ----------
 HTML_INDEX = """
 <!doctype html>
@@ -269,7 +906,7 @@ HTML_INDEX = """
       <div class="muted">셀피 <b>최소 1장 이상</b>을 올리면, 모든 사진을 참조로 사용해 <b>정체성 일관성</b>을 극대화하여 고품질 2장을 생성합니다.</div>
       <form action="/generate" method="post" enctype="multipart/form-data">
         <div class="row">
-          <label>셀피 업로드(최소 1장, 개수 제한 없음):
+          <label>셀피 업로드(최소 1장, 최대 6장, 장당 10MB 이하):
             <input type="file" name="selfies" accept="image/*" multiple required>
           </label>
         </div>
@@ -292,97 +929,177 @@ HTML_INDEX = """
 </html>
 """
 
+# ---------- 결과 페이지 (컷이 끝나는 대로 스트리밍, 템플릿은 import 시 한 번만 컴파일) ----------
+_RESULT_TEMPLATE_SOURCES = {
+    "head": """
+    <html><head><meta charset="utf-8"><title>결과 — {{ num_scenes }}컷</title>
+    <style>
+      body{font-family:system-ui,-apple-system,Segoe UI,Roboto,sans-serif;margin:32px;color:#111}
+      .grid{display:grid;grid-template-columns:repeat(2,1fr);gap:12px}
+      .bar{display:flex;gap:12px;align-items:center;margin-bottom:16px}
+      a.btn{background:#111;color:#fff;border-radius:10px;padding:8px 14px;text-decoration:none}
+      .muted{color:#666}
+      .note{border:1px solid #e5e7eb;border-radius:10px;padding:12px}
+    </style></head>
+    <body>
+      <div class="bar">
+        <a class="btn" href="/">← 다시 만들기</a>
+      </div>
+      <div class="grid">
+""",
+    "tile": """<div class="imgbox"><img src="{{ url }}" style="width:100%;display:block"/></div>
+""",
+    "tail": """
+      </div>
+      <div class="muted" style="margin-top:12px">생성 {{ num_images }}장</div>
+      {% if errors %}<div class="note" style="margin-top:16px;color:#b42318;border-color:#fecaca;background:#fff1f2"><b>일부 실패</b>{% for err in errors %}<br/>{{ err }}{% endfor %}</div>{% endif %}
+      <p class="muted" style="margin-top:18px">
+        모든 이미지는 Google Gemini가 삽입하는 <b>SynthID</b> 워터마크를 포함합니다.
+      </p>
+    </body></html>
+    """,
+}
+_RESULT_ENV = Environment(loader=DictLoader(_RESULT_TEMPLATE_SOURCES), autoescape=True,
+                          auto_reload=False, keep_trailing_newline=True)
+_RESULT_HEAD_TPL = _RESULT_ENV.get_template("head")
+_RESULT_TILE_TPL = _RESULT_ENV.get_template("tile")
+_RESULT_TAIL_TPL = _RESULT_ENV.get_template("tail")
+
+def result_head(num_scenes: int) -> str:
+    return _RESULT_HEAD_TPL.render(num_scenes=num_scenes)
+
+def result_tile(url: str) -> str:
+    return _RESULT_TILE_TPL.render(url=url)
+
+def result_tail(num_images: int, errors: List[str]) -> str:
+    return _RESULT_TAIL_TPL.render(num_images=num_images, errors=errors)
+
+# 고정 페이지는 import 시 한 번만 인코딩. Response 객체 자체는 재사용하지 않음
+# (GZipMiddleware 가 응답 헤더 리스트를 제자리에서 수정함)
+_INDEX_BODY = HTML_INDEX.encode("utf-8")
+_INDEX_ETAG = '"' + hashlib.sha256(_INDEX_BODY).hexdigest()[:16] + '"'
+_INDEX_CACHE_HEADERS = {"ETag": _INDEX_ETAG, "Cache-Control": "public, max-age=300"}
+
 # ---------- 라우트 ----------
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return HTML_INDEX
+def index(request: Request):
+    # 재방문 브라우저는 본문 없이 304
+    if request.headers.get("if-none-match") == _INDEX_ETAG:
+        return Response(status_code=304, headers=_INDEX_CACHE_HEADERS)
+    return HTMLResponse(_INDEX_BODY, headers=_INDEX_CACHE_HEADERS)
+
+@app.get("/metrics")
+def metrics():
+    return {"gemini": _AIMD.snapshot(), "rate_limit_rpm": GEMINI_RPM,
+            "rate_limit_rpm_per_client": GEMINI_RPM_PER_CLIENT}
 
 @app.post("/generate", response_class=HTMLResponse)
 async def generate(
-    selfies: List[UploadFile] = File(...),  # 개수 제한 없음
-    exact_billgates: bool = Form(False)
+    request: Request,
+    selfies: List[UploadFile] = File(...),  # 최대 MAX_REFS장까지 사용
+    exact_billgates: bool = Form(False),
+    character_type: str = Form(DEFAULT_CHARACTER),
+    no_cache: bool = Query(False),  # ?no_cache=1: 캐시 무시하고 강제 재생성
 ):
-    # ---- 업로드 파일 저장 (모든 사진 사용) ----
-    temp_paths = []
-    ref_images: List[Image.Image] = []
-    try:
-        if not selfies or len(selfies) < 1:
-            return HTMLResponse("<h3>셀피를 최소 1장 이상 업로드하세요.</h3>", status_code=400)
+    deadline = time.monotonic() + PER_REQUEST_DEADLINE_SEC  # 배치/보충/폴백 호출 모두 이 시각 안에서 끝냄
+    cfg = CHARACTERS.get(character_type)
+    if cfg is None:
+        return HTMLResponse("<h3>지원하지 않는 인물입니다.</h3>", status_code=400)
 
-        for i, uf in enumerate(selfies):  # 모든 사진 사용
-            temp_path = os.path.join(STATIC_DIR, f"upload_{i}_{uuid.uuid4().hex}")
-            with open(temp_path, "wb") as f:
-                shutil.copyfileobj(uf.file, f)
-            temp_paths.append(temp_path)
+    # ---- 업로드 사진을 메모리에서 바로 디코드 (디스크에 저장하지 않음, 앞에서부터 MAX_REFS장 사용) ----
+    if not selfies or len(selfies) < 1:
+        return HTMLResponse("<h3>셀피를 최소 1장 이상 업로드하세요.</h3>", status_code=400)
+    selfies = selfies[:MAX_REFS]
 
-            img = Image.open(temp_path).convert("RGB")
-            img = downscale_max_side(img, max_side=768)
-            ref_images.append(img)
+    # 상한 + 1 바이트까지만 읽어 초과 여부를 판단 (큰 파일 전체를 메모리에 올리지 않음)
+    datas = await asyncio.gather(*(uf.read(MAX_UPLOAD_BYTES + 1) for uf in selfies))
+    if any(len(data) > MAX_UPLOAD_BYTES for data in datas):
+        return HTMLResponse(f"<h3>사진 1장당 {MAX_UPLOAD_BYTES // (1024 * 1024)}MB 이하만 업로드할 수 있습니다.</h3>",
+                            status_code=413)
+    # 같은 파일을 여러 번 올린 경우 한 번만 디코드
+    unique_datas = list(dict.fromkeys(datas))
+    decoded = await asyncio.gather(
+        *(asyncio.to_thread(decode_and_resize, data, 768) for data in unique_datas)
+    )
+    # 픽셀까지 같은 참조(다시 저장한 사본 등)도 한 장만 보냄 — 입력 토큰/업로드 절감
+    by_digest = {digest: im for im, digest in decoded}
+    ref_digests = list(by_digest)
+    ref_images: List[Image.Image] = list(by_digest.values())
+    if len(ref_images) < len(datas):
+        logger.info("중복 참조 사진 %d장 제외 (%d → %d)", len(datas) - len(ref_images), len(datas), len(ref_images))
 
-        out_urls, errors = [], []
+    # 같은 참조 사진 + 장면 조합은 캐시된 결과를 바로 사용
+    # (no_cache=1 이면 조회만 건너뛰고 새 결과로 캐시를 갱신)
+    ref_dhashes: Tuple[int, ...] = tuple(await asyncio.gather(
+        *(asyncio.to_thread(ref_dhash, im) for im in ref_images)
+    )) if RESULT_CACHE_NEAR_DUP else ()
+    cache_keys: List[ResultKey] = []
+    for scene_label, scene_desc in cfg.scenes:
+        namespace = result_cache_namespace(
+            scene_label, compose_prompt(scene_label, scene_desc, exact_billgates, len(ref_images), character_type))
+        cache_keys.append(ResultKey(result_cache_key(ref_digests, namespace), namespace, ref_dhashes))
+    scene_urls: List[Optional[str]] = [None if no_cache else _RESULT_CACHE.lookup(k) for k in cache_keys]
+    pending = [i for i, u in enumerate(scene_urls) if u is None]
+    ctx = CallContext(deadline=deadline,
+                      client_limiter=_CLIENT_LIMITERS.get(request.client.host if request.client else "unknown"))
+    ref_parts: List[types.Part] = list(await asyncio.gather(
+        *(asyncio.to_thread(encode_reference, im) for im in ref_images)
+    )) if pending else []
 
-        for scene_label, scene_desc in SCENES:  # 2컷만
-            prompt = compose_prompt(scene_label, scene_desc, use_exact_billgates=exact_billgates, num_refs=len(ref_images))
-            try:
-                img_bytes = call_gemini_generate(ref_images, prompt)
-            except Exception as e1:
-                # 429/쿼터: 페일오버도 하지 않고 실패 기록 (다음 컷으로)
-                if is_quota_error(e1):
-                    errors.append(f"{scene_label}: 실패 — {e1}")
-                    continue
-                # 정책/콘텐츠 이슈 추정 시 look-alike로 1회 재시도
-                if exact_billgates:
-                    try:
-                        fallback_prompt = compose_prompt(scene_label, scene_desc, use_exact_billgates=False, num_refs=len(ref_images))
-                        img_bytes = call_gemini_generate(ref_images, fallback_prompt)
-                    except Exception as e2:
-                        errors.append(f"{scene_label}: 실패 — {e2}")
-                        continue
-                else:
-                    errors.append(f"{scene_label}: 실패 — {e1}")
-                    continue
+    async def stream_page():
+        tasks: List[asyncio.Future] = []
+        errors: List[str] = []
+        num_images = 0
+        call_ctx = ctx
+        try:
+            yield result_head(len(cfg.scenes))
+            for url in scene_urls:
+                if url is not None:
+                    num_images += 1
+                    yield result_tile(url)
 
-            # 이미지 저장 (워터마크 없음)
-            saved_url = save_image_bytes(img_bytes, suffix=".png")
-            out_urls.append(saved_url)
+            # 두 번 이상 호출할 때만 참조 사진을 캐시에 올릴 가치가 있음
+            if USE_CONTEXT_CACHE and len(pending) > 1:
+                # 캐시 생성에 시간을 다 쓰지 않도록 최소 호출 여유만큼은 남김
+                cached_content = await create_reference_cache(ref_parts, ctx.remaining() - MIN_CALL_BUDGET_SEC)
+                call_ctx = replace(ctx, cached_content=cached_content)
 
-    finally:
-        # 업로드 원본 즉시 삭제
-        for p in temp_paths:
-            try:
-                os.remove(p)
-            except:
-                pass
+            remaining = pending
+            if BATCH_SCENES_IN_ONE_CALL and len(pending) > 1:
+                batch_urls, batch_err = await generate_batch_and_save(
+                    [cfg.scenes[i] for i in pending], ref_parts, exact_billgates, character_type,
+                    [cache_keys[i] for i in pending], call_ctx,
+                )
+                for url in batch_urls:
+                    if url is not None:
+                        num_images += 1
+                        yield result_tile(url)
+                remaining = [i for i, url in zip(pending, batch_urls) if url is None]
+                if batch_err is not None and is_quota_error(batch_err):
+                    # 429/쿼터: 컷별 보충 호출도 실패할 것이므로 바로 실패 기록
+                    errors.extend(f"{cfg.scenes[i][0]}: 실패 — {batch_err}" for i in remaining)
+                    remaining = []
 
-    # ---- 결과 페이지 ----
-    thumbs = "".join(
-        f'<div class="imgbox"><img src="{u}" style="width:100%;display:block"/></div>'
-        for u in out_urls
-    )
-    err_html = ""
-    if errors:
-        err_list = "<br/>".join(errors)
-        err_html = f'<div class="note" style="margin-top:16px;color:#b42318;border-color:#fecaca;background:#fff1f2"><b>일부 실패</b><br/>{err_list}</div>'
+            # 남은 컷은 동시에 요청하고, 끝나는 순서대로 타일을 내보냄
+            tasks = [
+                asyncio.ensure_future(generate_and_save(*cfg.scenes[i], ref_parts, exact_billgates,
+                                                        character_type, cache_keys[i], call_ctx))
+                for i in remaining
+            ]
+            for next_done in asyncio.as_completed(tasks):
+                url, err = await next_done
+                if url is None:
+                    errors.append(err)
+                    continue
+                num_images += 1
+                yield result_tile(url)
+            yield result_tail(num_images, errors)
+        finally:
+            for t in tasks:  # 클라이언트가 연결을 끊으면 남은 호출 취소
+                t.cancel()
+            if call_ctx.cached_content is not None:
+                schedule_reference_cache_delete(call_ctx.cached_content)
 
-    html = f"""
-    <html><head><meta charset="utf-8"><title>결과 — 2컷</title>
-    <style>
-      body{{font-family:system-ui,-apple-system,Segoe UI,Roboto,sans-serif;margin:32px;color:#111}}
-      .grid{{display:grid;grid-template-columns:repeat(2,1fr);gap:12px}}
-      .bar{{display:flex;gap:12px;align-items:center;margin-bottom:16px}}
-      a.btn{{background:#111;color:#fff;border-radius:10px;padding:8px 14px;text-decoration:none}}
-      .muted{{color:#666}}
-    </style></head>
-    <body>
-      <div class="bar">
-        <a class="btn" href="/">← 다시 만들기</a>
-        <div class="muted">생성 {len(out_urls)}장</div>
-      </div>
-      <div class="grid">{thumbs}</div>
-      {err_html}
-      <p class="muted" style="margin-top:18px">
-        모든 이미지는 Google Gemini가 삽입하는 <b>SynthID</b> 워터마크를 포함합니다.
-      </p>
-    </body></html>
-    """
-    return HTMLResponse(html)
+    # X-Accel-Buffering: 리버스 프록시(nginx)가 응답을 모았다가 보내지 않도록 함
+    return StreamingResponse(stream_page(), media_type="text/html",
+                             headers={"X-Accel-Buffering": "no"})
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import time
+import unittest
+
+import requests
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+
+def _controller() -> app.AIMDController:
+    return app.AIMDController(c_min=1, c_max=8, c_init=4, alpha=1.0, beta=0.5,
+                              latency_target_sec=100.0, window=10)
+
+
+async def _hold(controller: app.AIMDController, deadline: float):
+    async with controller.slot(deadline):
+        await asyncio.sleep(10)
+
+
+class AIMDSlotTest(unittest.TestCase):
+    def test_cancel_before_deadline_keeps_the_limit(self):
+        # 클라이언트 연결 종료 등으로 마감 전에 취소된 호출은 과부하 신호가 아님
+        async def run():
+            controller = _controller()
+            task = asyncio.create_task(_hold(controller, time.monotonic() + 5))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return controller
+
+        controller = asyncio.run(run())
+        self.assertEqual(controller.limit, 4.0)
+        self.assertEqual(controller.backoffs, 0)
+
+    def test_deadline_timeout_halves_the_limit(self):
+        async def run():
+            controller = _controller()
+            deadline = time.monotonic() + 0.05
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(_hold(controller, deadline), timeout=deadline - time.monotonic())
+            return controller
+
+        self.assertEqual(asyncio.run(run()).limit, 2.0)
+
+    def test_sdk_transport_timeout_halves_the_limit(self):
+        async def run():
+            controller = _controller()
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                async with controller.slot():
+                    raise requests.exceptions.ReadTimeout()
+            return controller
+
+        self.assertEqual(asyncio.run(run()).limit, 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
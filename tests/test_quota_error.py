@@ -0,0 +1,23 @@
+import os
+import unittest
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+
+class IsQuotaErrorTest(unittest.TestCase):
+    def test_quota_messages_match(self):
+        for message in ("429 RESOURCE_EXHAUSTED", "Rate limit exceeded", "x-ratelimit-remaining: 0", "HTTP 429"):
+            with self.subTest(message=message):
+                self.assertTrue(app.is_quota_error(Exception(message)))
+
+    def test_words_containing_rate_do_not_match(self):
+        # "rate"가 들어간 일반 단어/숫자는 쿼터 오류가 아님 (재시도·폴백 판단이 바뀜)
+        for message in ("failed to generate image", "moderate content detected", "request id 14290", "500 INTERNAL"):
+            with self.subTest(message=message):
+                self.assertFalse(app.is_quota_error(Exception(message)))
+
+
+if __name__ == "__main__":
+    unittest.main()
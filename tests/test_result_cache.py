@@ -0,0 +1,58 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+
+class ResultCacheEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.static_dir = app.STATIC_DIR
+        app.STATIC_DIR = self.tmp.name
+        self.addCleanup(setattr, app, "STATIC_DIR", self.static_dir)
+
+    def _save(self, name: str, size: int) -> str:
+        with open(os.path.join(self.tmp.name, name), "wb") as f:
+            f.write(b"x" * size)
+        return f"/static/{name}"
+
+    def test_put_never_evicts_the_new_entry(self):
+        async def run():
+            cache = app.ResultCache(os.path.join(self.tmp.name, "index.json"), max_bytes=250, ttl_sec=3600)
+            for n in range(2):
+                cache.put(app.ResultKey(f"k{n}", "ns"), self._save(f"k{n}.webp", 100), 100)
+                self.assertIsNotNone(cache.get(f"k{n}"))  # 방문 비트 켜기
+            new_url = self._save("k2.webp", 100)
+            cache.put(app.ResultKey("k2", "ns"), new_url, 100)
+            await asyncio.gather(*cache._flushes)
+            return cache, new_url
+
+        cache, new_url = asyncio.run(run())
+        self.assertIn("k2", cache._entries)
+        self.assertEqual(len(cache._entries), 2)
+        self.assertLessEqual(cache._total_bytes, 250)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "k2.webp")))
+        self.assertEqual(cache.get("k2"), new_url)
+
+    def test_overwrite_keeps_the_previous_file(self):
+        async def run():
+            cache = app.ResultCache(os.path.join(self.tmp.name, "index.json"), max_bytes=1000, ttl_sec=3600)
+            cache.put(app.ResultKey("k", "ns"), self._save("old.webp", 100), 100)
+            new_url = self._save("new.webp", 100)
+            cache.put(app.ResultKey("k", "ns"), new_url, 100)
+            await asyncio.gather(*cache._flushes)
+            return cache, new_url
+
+        cache, new_url = asyncio.run(run())
+        self.assertEqual(cache.get("k"), new_url)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "old.webp")))  # 이미 내보낸 URL
+        self.assertEqual(cache._total_bytes, 200)  # 이전 파일도 용량/축출 대상으로 남음
+
+
+if __name__ == "__main__":
+    unittest.main()